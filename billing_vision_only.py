@@ -14,6 +14,8 @@ Environment variables (optional):
 - SMART_GROCERY_BOX_COOLDOWN_SECONDS: default 2.0
 - SMART_GROCERY_BOX_UNIT: default "pcs"
 - SMART_GROCERY_BOX_PRICES_FILE: default "prices.json" (label -> price)
+- SMART_GROCERY_BOX_LOG_LEVEL: default "INFO" (DEBUG prints per-frame scores)
+- SMART_GROCERY_BOX_CV_THREADS: default 2 (OpenCV worker threads)
 
 Usage:
   python3 billing_vision_only.py modelfile.eim [camera_id]
@@ -21,30 +23,256 @@ Usage:
 
 import os
 import sys
+import glob
 import time
-import json
-from typing import Dict, Any
+import struct
+import queue
+import functools
+import logging
+import logging.handlers
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
 
 import cv2
-import requests
+import httpx
+import numpy as np
+import orjson
 from edge_impulse_linux.image import ImageImpulseRunner
 
 
-def now_ms() -> int:
-    return round(time.time() * 1000)
+logger = logging.getLogger("autobill")
 
+# struct v4l2_capability from <linux/videodev2.h>
+_V4L2_CAPABILITY_SIZE = 104
+_VIDIOC_QUERYCAP = 0x80685600
+_V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+_V4L2_CAP_DEVICE_CAPS = 0x80000000
 
-def get_webcams(max_ports: int = 5):
-    port_ids = []
-    for port in range(max_ports):
+# shared keep-alive connection to the CheckoutUI API
+_client = httpx.Client(timeout=httpx.Timeout(5.0), transport=httpx.HTTPTransport(retries=1))
+_JSON_HEADERS = {"Content-Type": "application/json"}
+# cart payloads waiting to be POSTed by the sender thread
+_send_q: queue.Queue = queue.Queue()
+
+
+def _probe_port(port: int) -> bool:
+    if sys.platform == "linux":
+        cap = cv2.VideoCapture(port, cv2.CAP_V4L2)
+    else:
         cap = cv2.VideoCapture(port)
-        if cap is None or not cap.isOpened():
-            continue
+    if cap is None or not cap.isOpened():
+        return False
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    # a negotiated frame size is enough; only grab a frame if it is missing
+    ok = cap.get(cv2.CAP_PROP_FRAME_WIDTH) > 0
+    if not ok:
         ok, _ = cap.read()
-        if ok:
-            port_ids.append(port)
+    cap.release()
+    return ok
+
+
+def _v4l2_is_capture(path: str) -> Optional[bool]:
+    # VIDIOC_QUERYCAP on the device node; None when the answer is unknown
+    import fcntl
+
+    buf = bytearray(_V4L2_CAPABILITY_SIZE)
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, _VIDIOC_QUERYCAP, buf)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    caps, device_caps = struct.unpack_from("<II", buf, 84)
+    if caps & _V4L2_CAP_DEVICE_CAPS:
+        caps = device_caps
+    return bool(caps & _V4L2_CAP_VIDEO_CAPTURE)
+
+
+def _is_webcam(port: int) -> bool:
+    if sys.platform == "linux":
+        is_capture = _v4l2_is_capture(f"/dev/video{port}")
+        if is_capture is not None:
+            return is_capture
+    return _probe_port(port)
+
+
+def get_webcams(max_ports: int = 5):
+    if sys.platform == "linux":
+        candidates = []
+        for path in glob.glob("/dev/video*"):
+            suffix = path.rsplit("video", 1)[1]
+            if suffix.isdigit() and int(suffix) < max_ports:
+                candidates.append(int(suffix))
+        candidates.sort()
+    else:
+        candidates = list(range(max_ports))
+    if not candidates:
+        return []
+
+    # probe in parallel so a slow/unused port doesn't hold up the others
+    with ThreadPoolExecutor(max_workers=len(candidates)) as ex:
+        found = list(ex.map(_is_webcam, candidates))
+    return [port for port, ok in zip(candidates, found) if ok]
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    # log records are formatted/written by a listener thread, off the frame loop
+    level = os.environ.get("SMART_GROCERY_BOX_LOG_LEVEL", "INFO").upper()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[AutoBill] %(message)s"))
+    log_q: queue.Queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_q, handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_q))
+    logger.propagate = False
+    listener.start()
+    try:
+        logger.setLevel(level)
+    except ValueError:
+        logger.setLevel(logging.INFO)
+        logger.warning("Unknown SMART_GROCERY_BOX_LOG_LEVEL %r, using INFO", level)
+    return listener
+
+
+def put_latest(q: queue.Queue, item):
+    # drop the oldest entry when full so consumers always see the current view
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def open_camera(cam_id: int, width: int, height: int):
+    # ask for compressed frames at a small size; the model input is tiny anyway
+    if sys.platform == "linux":
+        cap = cv2.VideoCapture(cam_id, cv2.CAP_V4L2)
+    else:
+        cap = cv2.VideoCapture(cam_id)
+    if not cap.isOpened():
         cap.release()
-    return port_ids
+        raise RuntimeError(f"Couldn't initialize camera {cam_id}")
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+
+def configure_opencv():
+    # leave cores free for capture, the EIM runner and the sender thread
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(int(os.environ.get("SMART_GROCERY_BOX_CV_THREADS", "2")))
+
+
+def pin_to_last_cores():
+    # OpenCV's worker threads are spawned lazily from this thread and inherit
+    # its affinity, so reserve as many cores as the OpenCV pool is allowed
+    cpus = os.cpu_count() or 1
+    n = max(1, cv2.getNumThreads())
+    if hasattr(os, "sched_setaffinity") and cpus >= 4 and n < cpus:
+        try:
+            # on Linux pid 0 means the calling thread
+            os.sched_setaffinity(0, set(range(cpus - n, cpus)))
+        except OSError:
+            pass
+
+
+def capture_worker(runner, cam_id: int, size, frame_q: queue.Queue, want_frame: threading.Event,
+                   stop: threading.Event, failed: threading.Event):
+    pin_to_last_cores()
+    cap = None
+    # frame buffers reused across iterations; a frame is only decoded when the
+    # inference thread asks for one and its features are extracted before the
+    # next retrieve, so one BGR/RGB pair is enough
+    bgr = None
+    rgb = None
+    try:
+        cap = open_camera(cam_id, *size)
+        while not stop.is_set():
+            ok = cap.grab()
+            if ok and not want_frame.is_set():
+                # nobody is waiting; the next grab supersedes this frame
+                continue
+            if ok:
+                want_frame.clear()
+                ok, bgr = cap.retrieve(bgr)
+            if not ok:
+                logger.error("Lost camera %s", cam_id)
+                failed.set()
+                break
+            if rgb is None or rgb.shape != bgr.shape:
+                rgb = np.empty_like(bgr)
+            # Edge Impulse expects RGB input
+            cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=rgb)
+            features, _ = runner.get_features_from_image(rgb)
+            put_latest(frame_q, features)
+    except Exception as e:
+        logger.error("ERROR during capture: %s", e)
+        failed.set()
+    finally:
+        if cap is not None:
+            cap.release()
+        put_latest(frame_q, None)
+
+
+def infer_worker(runner, frame_q: queue.Queue, want_frame: threading.Event, result_q: queue.Queue,
+                 stop: threading.Event, failed: threading.Event):
+    deadline_ns = 0  # ~10 fps cap, on the monotonic clock
+    try:
+        while not stop.is_set():
+            wait_ns = deadline_ns - time.monotonic_ns()
+            # waiting on the stop event keeps shutdown responsive during the cap
+            if wait_ns > 0 and stop.wait(wait_ns / 1e9):
+                break
+
+            # ask capture for the next frame only once we are ready to use it
+            want_frame.set()
+            features = frame_q.get()
+            if features is None:
+                break
+            res = runner.classify(features)
+            put_latest(result_q, res)
+
+            deadline_ns = time.monotonic_ns() + 100_000_000
+    except Exception as e:
+        logger.error("ERROR during inference: %s", e)
+        failed.set()
+    finally:
+        put_latest(result_q, None)
+
+
+def update_state(best_score: float, best_idx: int, cur_idx: int, streak: int,
+                 threshold: float, streak_frames: int,
+                 last_sent: float, now: float, cooldown_s: float):
+    """Advance the detection streak by one frame.
+
+    Works purely on label indices (-1 means no candidate). Returns
+    (cur_idx, streak, should_send, last_sent); when should_send is True the
+    item at best_idx is due to be added and the streak has been reset.
+    """
+    if best_score >= threshold:
+        if best_idx == cur_idx:
+            streak += 1
+        else:
+            cur_idx = best_idx
+            streak = 1
+    else:
+        cur_idx = -1
+        streak = 0
+
+    if cur_idx >= 0 and streak >= streak_frames and (now - last_sent) >= cooldown_s:
+        # reset streak so we don't instantly add again
+        return -1, 0, True, now
+    return cur_idx, streak, False, last_sent
 
 
 def load_prices(labels):
@@ -53,8 +281,8 @@ def load_prices(labels):
     default_prices = {label: 1.0 for label in labels}
     if os.path.exists(prices_file):
         try:
-            with open(prices_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(prices_file, "rb") as f:
+                data = orjson.loads(f.read())
             # keep only known labels; allow extra keys (ignored)
             for k, v in data.items():
                 if k in default_prices:
@@ -65,19 +293,43 @@ def load_prices(labels):
     else:
         # write a template prices.json for convenience
         try:
-            with open(prices_file, "w", encoding="utf-8") as f:
-                json.dump(default_prices, f, indent=2)
+            with open(prices_file, "wb") as f:
+                f.write(orjson.dumps(default_prices, option=orjson.OPT_INDENT_2))
             print(f"[Smart-Grocery-Box] Created {prices_file} template. Edit it to set real prices.")
         except Exception:
             pass
-    return default_prices
+    # indexed like labels so the hot loop never hashes a label string
+    return np.fromiter((default_prices[label] for label in labels),
+                       dtype=np.float64, count=len(labels))
+
+
+@functools.lru_cache(maxsize=None)
+def product_template(pid: int, name: str, price: float, unit: str) -> bytes:
+    # everything but the counters is fixed per product, so serialize it once
+    head = orjson.dumps({"id": pid, "name": name, "price": price, "unit": unit})
+    return head[:-1] + b',"taken":'
 
 
-def post_product(api_url: str, product: Dict[str, Any]):
-    headers = {"Content-Type": "application/json"}
-    r = requests.post(api_url, headers=headers, data=json.dumps(product), timeout=5)
+def render_product(template: bytes, taken: int, payable: float) -> bytes:
+    return b"".join((template, str(taken).encode(), b',"payable":', orjson.dumps(payable), b"}"))
+
+
+def post_product(api_url: str, body: bytes):
+    r = _client.post(api_url, content=body, headers=_JSON_HEADERS)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+
+def _sender_loop(api_url: str):
+    while True:
+        body = _send_q.get()
+        if body is None:
+            break
+        try:
+            resp = post_product(api_url, body)
+            logger.info("Added -> %s", resp)
+        except Exception as e:
+            logger.error("ERROR posting to API: %s", e)
 
 
 def main(argv):
@@ -85,6 +337,8 @@ def main(argv):
         print("Usage: python3 billing_vision_only.py modelfile.eim [camera_id]")
         sys.exit(2)
 
+    log_listener = setup_logging()
+    configure_opencv()
     model_path = argv[1]
     if not os.path.exists(model_path):
         # try relative to script dir
@@ -115,78 +369,92 @@ def main(argv):
     print(f"[AutoBill] API URL: {api_url}")
     print(f"[AutoBill] threshold={threshold}, streak_frames={streak_frames}, cooldown_s={cooldown_s}")
 
-    cart: Dict[int, Dict[str, Any]] = {}
-    last_sent = 0.0
-    current_label = None
+    # units taken per product id; the rest of the payload lives in product_template
+    cart: Dict[int, int] = {}
+    last_sent = float("-inf")
+    current_idx = -1
     streak = 0
 
     runner = None
     with ImageImpulseRunner(model_path) as runner:
         model_info = runner.init()
-        labels = model_info["model_parameters"]["labels"]
+        params = model_info["model_parameters"]
+        labels = params["labels"]
+        # smallest common camera mode that still covers the model input
+        capture_size = (max(320, int(params["image_input_width"])),
+                        max(240, int(params["image_input_height"])))
 
-        # stable numeric ids per label
-        label_to_id = {label: i + 1 for i, label in enumerate(labels)}
-        prices = load_prices(labels)
+        # stable numeric ids and prices, indexed like labels
+        label_ids = np.arange(1, len(labels) + 1, dtype=np.int32)
+        prices_arr = load_prices(labels)
 
         print("[AutoBill] Labels:", labels)
+        # reused every frame for the argmax over label scores
+        score_buf = np.zeros(len(labels), dtype=np.float32)
+
+        stop = threading.Event()
+        # set by a worker that ended on an error rather than a requested stop
+        failed = threading.Event()
+        # capture decodes a frame on demand and hands it over through frame_q
+        want_frame = threading.Event()
+        frame_q: queue.Queue = queue.Queue(maxsize=1)
+        result_q: queue.Queue = queue.Queue(maxsize=2)
+        workers = [
+            threading.Thread(target=capture_worker, args=(runner, cam_id, capture_size, frame_q, want_frame, stop, failed), daemon=True),
+            threading.Thread(target=infer_worker, args=(runner, frame_q, want_frame, result_q, stop, failed), daemon=True),
+        ]
+        sender = threading.Thread(target=_sender_loop, args=(api_url,), daemon=True)
+        sender.start()
+        for worker in workers:
+            worker.start()
 
-        next_frame = 0  # ~10 fps cap
-        for res, img in runner.classifier(cam_id):
-            if next_frame > now_ms():
-                time.sleep((next_frame - now_ms()) / 1000.0)
-
-            if "classification" not in res["result"]:
-                next_frame = now_ms() + 100
-                continue
-
-            scores = res["result"]["classification"]
-            best_label = max(labels, key=lambda l: scores.get(l, 0.0))
-            best_score = float(scores.get(best_label, 0.0))
-
-            # basic console logging
-            print(f"[AutoBill] {best_label}: {best_score:.3f}", flush=True)
-
-            if best_score >= threshold:
-                if best_label == current_label:
-                    streak += 1
-                else:
-                    current_label = best_label
-                    streak = 1
-            else:
-                current_label = None
-                streak = 0
-
-            can_send = (time.time() - last_sent) >= cooldown_s
-            if current_label and streak >= streak_frames and can_send:
-                pid = label_to_id[current_label]
-                price = float(prices.get(current_label, 0.0))
-
-                if pid not in cart:
-                    cart[pid] = {
-                        "id": pid,
-                        "name": current_label,
-                        "price": price,
-                        "unit": unit,
-                        "taken": 0,
-                        "payable": 0.0
-                    }
-
-                cart[pid]["taken"] += 1
-                cart[pid]["payable"] = float(cart[pid]["taken"]) * price
-
-                try:
-                    resp = post_product(api_url, cart[pid])
-                    print(f"[AutoBill] Added -> {resp}")
-                except Exception as e:
-                    print(f"[AutoBill] ERROR posting to API: {e}")
-
-                last_sent = time.time()
-                # reset streak so we don't instantly add again
-                streak = 0
-                current_label = None
-
-            next_frame = now_ms() + 100
+        try:
+            while True:
+                res = result_q.get()
+                if res is None:
+                    break
+                t = time.monotonic()
+
+                if "classification" not in res["result"]:
+                    continue
+
+                scores = res["result"]["classification"]
+                _get = scores.get
+                for i, l in enumerate(labels):
+                    score_buf[i] = _get(l, 0.0)
+                best_idx = int(score_buf.argmax())
+                best_score = float(score_buf[best_idx])
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("%s: %.3f", labels[best_idx], best_score)
+
+                current_idx, streak, should_send, last_sent = update_state(
+                    best_score, best_idx, current_idx, streak,
+                    threshold, streak_frames, last_sent, t, cooldown_s,
+                )
+                if should_send:
+                    pid = int(label_ids[best_idx])
+                    price = float(prices_arr[best_idx])
+
+                    taken = cart.get(pid, 0) + 1
+                    cart[pid] = taken
+
+                    # bytes are immutable, so later increments can't race the sender
+                    template = product_template(pid, labels[best_idx], price, unit)
+                    _send_q.put(render_product(template, taken, taken * price))
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join(timeout=2.0)
+            # drain pending POSTs before closing the connection
+            _send_q.put(None)
+            sender.join()
+            _client.close()
+            log_listener.stop()
+
+    if failed.is_set():
+        # non-zero so a supervisor (e.g. systemd Restart=on-failure) restarts us
+        sys.exit(1)
 
 
 if __name__ == "__main__":